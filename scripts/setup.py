@@ -67,6 +67,11 @@ def install_dependencies():
             print("3. Run: pip install -r requirements.txt")
             return False
 
+def _has_placeholder(path):
+    """Return True if the file still contains the API key placeholder."""
+    with open(path, 'r') as f:
+        return any('your-api-key-here' in line for line in f)
+
 def check_config():
     """Check if config.py exists and has API key."""
     if not os.path.exists('config.py'):
@@ -88,10 +93,7 @@ TOP_K_CHUNKS = 5  # Number of document chunks to retrieve
     
     # Check if API key is set
     try:
-        with open('config.py', 'r') as f:
-            content = f.read()
-        
-        if 'your-api-key-here' in content:
+        if _has_placeholder('config.py'):
             print("WARNING: Please set your OpenAI API key in config.py")
             return False
         else:
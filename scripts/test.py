@@ -36,7 +36,7 @@ def simple_test():
     print("\n3. CREATING VECTOR STORE...")
     # Just use the first 100 docs for faster testing
     vs = create_vector_store(docs[:400]) # here the chunks become vectors
-    print(f"SUCCESS: Vector store ready with {len(vs.documents)} documents")
+    print(f"SUCCESS: Vector store ready with {len(vs)} documents")
     
     # Step 4: Test search
     print("\n4. TESTING SEARCH...")
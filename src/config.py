@@ -3,6 +3,7 @@
 
 from pydantic import BaseModel, Field
 from pathlib import Path
+import functools
 import json
 
 class Config(BaseModel):
@@ -20,16 +21,15 @@ class Config(BaseModel):
             data = json.load(f)
         return cls(**data)  # Pydantic validates here!
 
-_config = Config.load_from_file()
-
-OPENAI_API_KEY = _config.openai_api_key
-EMBEDDING_MODEL = _config.embedding_model
-CHUNK_SIZE = _config.chunk_size
-CHUNK_OVERLAP = _config.chunk_overlap
-TOP_K_CHUNKS = _config.top_k_chunks
-
-
-
-
+@functools.lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Load config.json on first use and reuse it afterwards."""
+    return Config.load_from_file()
 
+_SETTINGS = {"OPENAI_API_KEY", "EMBEDDING_MODEL", "CHUNK_SIZE", "CHUNK_OVERLAP", "TOP_K_CHUNKS"}
 
+def __getattr__(name: str):
+    """Resolve settings such as OPENAI_API_KEY lazily from get_config()."""
+    if name in _SETTINGS:
+        return getattr(get_config(), name.lower())
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
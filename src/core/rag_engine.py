@@ -1,34 +1,137 @@
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator
+from collections import OrderedDict
+import asyncio
+import hashlib
+import threading
+import weakref
+import numpy as np
+from openai import AsyncOpenAI, OpenAI
 from src.core.vector_store import SimpleVectorStore
 from src import config
 
+# Chat completion settings shared by every answer path
+_COMPLETION_SETTINGS = {
+    "model": "gpt-3.5-turbo",  # You can change this to gpt-4 if you prefer
+    "max_tokens": 500,
+    "temperature": 0.7
+}
+
+def _shingles(text: str, size: int = 3) -> set:
+    """Word n-grams used for near-duplicate detection."""
+    words = text.lower().split()
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+def _dedupe_chunks(relevant_chunks: List[Tuple[Dict, float]], threshold: float = 0.8) -> List[Tuple[Dict, float]]:
+    """Drop exact and near-duplicate chunks, keeping the highest-scoring copy."""
+    seen_hashes = set()
+    kept_shingles = []
+    unique = []
+    for doc, score in relevant_chunks:
+        fingerprint = hashlib.blake2b(doc['content'].encode('utf-8'), digest_size=8).digest()
+        if fingerprint in seen_hashes:
+            continue
+        shingles = _shingles(doc['content'])
+        if any(len(shingles & other) / len(shingles | other) > threshold for other in kept_shingles):
+            continue
+        seen_hashes.add(fingerprint)
+        kept_shingles.append(shingles)
+        unique.append((doc, score))
+    return unique
+
 class TravelRAGEngine:
     """Main RAG engine for travel questions."""
     
-    def __init__(self, vector_store: SimpleVectorStore):
+    def __init__(self, vector_store: SimpleVectorStore, cache_size: int = 256, semantic_threshold: float = 0.97):
         """Initialize the RAG engine with a vector store."""
         self.vector_store = vector_store
+        self.cache_size = cache_size
+        self.semantic_threshold = semantic_threshold
+        self._answer_cache = OrderedDict()
+        self._qcache_emb = np.empty((0, vector_store.dimension), dtype=np.float32)
+        self._qcache_keys = []
+        self._store_version = vector_store.version
+        self._cache_lock = threading.Lock()  # The engine is shared across Streamlit sessions
         
         # Check if API key is set
         if config.OPENAI_API_KEY == "your-api-key-here":
             print("⚠️  Warning: Please set your OpenAI API key in config.py")
+        
+        # One client for the engine's lifetime keeps the HTTP connection pool warm
+        self._client = OpenAI(api_key=config.OPENAI_API_KEY, timeout=30.0, max_retries=2)
+        self._aclients = weakref.WeakKeyDictionary()  # Event loop -> AsyncOpenAI, see _async_client
+    
+    def _async_client(self) -> AsyncOpenAI:
+        """Return the async client for the running event loop, creating it on first use."""
+        # Its connection pool is bound to one loop, so asyncio.run() per call needs a fresh one
+        loop = asyncio.get_running_loop()
+        client = self._aclients.get(loop)
+        if client is None:
+            client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, timeout=30.0, max_retries=2)
+            self._aclients[loop] = client
+        return client
     
-    def retrieve_relevant_chunks(self, query: str, top_k: int = None) -> List[Tuple[Dict, float]]:
+    def retrieve_relevant_chunks(self, query: str, top_k: int = None, query_embedding: np.ndarray = None) -> List[Tuple[Dict, float]]:
         """Retrieve relevant document chunks for a query."""
         if top_k is None:
             top_k = config.TOP_K_CHUNKS
         
+        if query_embedding is not None:
+            return self.vector_store.search_by_embedding(query_embedding, top_k)
         return self.vector_store.search(query, top_k)
     
-    def generate_answer(self, query: str, relevant_chunks: List[Tuple[Dict, float]]) -> str:
-        """Generate an answer using OpenAI's GPT API."""
+    def _similar_cached_answer(self, query_embedding: np.ndarray):
+        """Return the cached result of a near-identical query, if any."""
+        if not self._qcache_keys:
+            return None
         
-        if not relevant_chunks:
-            return "I couldn't find any relevant information to answer your question."
+        similarities = self._qcache_emb @ query_embedding[0]
+        best = int(np.argmax(similarities))
+        if similarities[best] <= self.semantic_threshold:
+            return None
+        
+        key = self._qcache_keys[best]
+        self._answer_cache.move_to_end(key)
+        return self._answer_cache[key]
+    
+    def _check_store_version(self):
+        """Drop cached answers if the vector store has changed since they were made."""
+        if self._store_version != self.vector_store.version:
+            self._answer_cache.clear()
+            self._qcache_emb = np.empty((0, self.vector_store.dimension), dtype=np.float32)
+            self._qcache_keys = []
+            self._store_version = self.vector_store.version
+    
+    def _store_answer(self, key: str, query_embedding: np.ndarray, result: Dict):
+        """Add a result to the answer cache, evicting the least recently used entry."""
+        if self.cache_size <= 0:
+            return
         
-        # Prepare context from retrieved chunks
+        with self._cache_lock:
+            self._check_store_version()
+            
+            # Another session may have cached the same question meanwhile
+            if key in self._answer_cache:
+                self._answer_cache[key] = result
+                self._answer_cache.move_to_end(key)
+                self._qcache_emb[self._qcache_keys.index(key)] = query_embedding[0]
+                return
+            
+            if len(self._answer_cache) >= self.cache_size:
+                evicted, _ = self._answer_cache.popitem(last=False)
+                row = self._qcache_keys.index(evicted)
+                self._qcache_keys.pop(row)
+                self._qcache_emb = np.delete(self._qcache_emb, row, axis=0)
+            
+            self._answer_cache[key] = result
+            self._qcache_keys.append(key)
+            self._qcache_emb = np.vstack([self._qcache_emb, query_embedding])
+    
+    def _build_messages(self, query: str, relevant_chunks: List[Tuple[Dict, float]]) -> List[Dict]:
+        """Build the chat messages for a query and its retrieved chunks."""
+        
+        # Prepare context from retrieved chunks, without sending repeated text twice
         context_parts = []
-        for doc, score in relevant_chunks:
+        for doc, score in _dedupe_chunks(relevant_chunks):
             context_parts.append(f"Source: {doc['title']}\nContent: {doc['content']}\n")
         
         context = "\n".join(context_parts)
@@ -44,19 +147,34 @@ class TravelRAGEngine:
         
         Answer:"""
         
+        return [
+            {"role": "system", "content": "You are a helpful travel assistant. Answer questions based on the provided context."},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _format_sources(self, relevant_chunks: List[Tuple[Dict, float]]) -> List[Dict]:
+        """Prepare retrieved chunks for display."""
+        sources = []
+        for doc, score in relevant_chunks:
+            sources.append({
+                "title": doc['title'],
+                "content": doc['content'],  # Show full content without truncation
+                "score": f"{score:.3f}",
+                "source_file": doc['source_file']
+            })
+        return sources
+    
+    def generate_answer(self, query: str, relevant_chunks: List[Tuple[Dict, float]]) -> str:
+        """Generate an answer using OpenAI's GPT API."""
+        
+        if not relevant_chunks:
+            return "I couldn't find any relevant information to answer your question."
+        
         try:
             # Call OpenAI API (new v1.0+ format)
-            from openai import OpenAI
-            client = OpenAI(api_key=config.OPENAI_API_KEY)
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",  # You can change this to gpt-4 if you prefer
-                messages=[
-                    {"role": "system", "content": "You are a helpful travel assistant. Answer questions based on the provided context."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=500,
-                temperature=0.7
+            response = self._client.chat.completions.create(
+                messages=self._build_messages(query, relevant_chunks),
+                **_COMPLETION_SETTINGS
             )
             
             return response.choices[0].message.content.strip()
@@ -64,13 +182,60 @@ class TravelRAGEngine:
         except Exception as e:
             return f"Error generating answer: {str(e)}"
     
+    def generate_answer_stream(self, query: str, relevant_chunks: List[Tuple[Dict, float]]) -> Iterator[str]:
+        """Generate an answer using OpenAI's GPT API, yielding text as it arrives."""
+        
+        if not relevant_chunks:
+            yield "I couldn't find any relevant information to answer your question."
+            return
+        
+        try:
+            response = self._client.chat.completions.create(
+                messages=self._build_messages(query, relevant_chunks),
+                stream=True,
+                **_COMPLETION_SETTINGS
+            )
+            
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            
+        except Exception as e:
+            yield f"Error generating answer: {str(e)}"
+    
+    def _lookup_cache(self, query: str):
+        """Return (cache_key, query_embedding, cached_result), with no embedding on an exact hit."""
+        cache_key = " ".join(query.lower().split())
+        with self._cache_lock:
+            self._check_store_version()
+            cached = self._answer_cache.get(cache_key)
+            if cached is not None:
+                self._answer_cache.move_to_end(cache_key)
+        if cached is not None:
+            print("Using cached answer")
+            return cache_key, None, {**cached, "query": query}
+        
+        query_embedding = self.vector_store.encode_query(query)
+        with self._cache_lock:
+            cached = self._similar_cached_answer(query_embedding)
+        if cached is not None:
+            print("Using cached answer for a similar question")
+            return cache_key, query_embedding, {**cached, "query": query}
+        
+        return cache_key, query_embedding, None
+    
     def answer_question(self, query: str) -> Dict:
         """Main method to answer a travel question using RAG."""
         
+        # Reuse answers for repeated or near-identical questions
+        cache_key, query_embedding, cached = self._lookup_cache(query)
+        if cached is not None:
+            return cached
+        
         print(f"Searching for relevant information...")
         
         # Retrieve relevant chunks
-        relevant_chunks = self.retrieve_relevant_chunks(query)
+        relevant_chunks = self.retrieve_relevant_chunks(query, query_embedding=query_embedding)
         
         if not relevant_chunks:
             return {
@@ -85,18 +250,102 @@ class TravelRAGEngine:
         print("Generating answer...")
         answer = self.generate_answer(query, relevant_chunks)
         
-        # Prepare sources for display
-        sources = []
-        for doc, score in relevant_chunks:
-            sources.append({
-                "title": doc['title'],
-                "content": doc['content'],  # Show full content without truncation
-                "score": f"{score:.3f}",
-                "source_file": doc['source_file']
+        result = {
+            "answer": answer,
+            "sources": self._format_sources(relevant_chunks),
+            "query": query
+        }
+        
+        # Don't cache failures, so the next attempt retries the API
+        if not answer.startswith("Error generating answer"):
+            self._store_answer(cache_key, query_embedding, result)
+        
+        return result
+    
+    def answer_question_stream(self, query: str) -> Dict:
+        """Like answer_question, but with an "answer_stream" iterator instead of the finished "answer"."""
+        
+        cache_key, query_embedding, cached = self._lookup_cache(query)
+        if cached is not None:
+            return {
+                "answer_stream": iter([cached["answer"]]),
+                "sources": cached["sources"],
+                "query": query
+            }
+        
+        relevant_chunks = self.retrieve_relevant_chunks(query, query_embedding=query_embedding)
+        sources = self._format_sources(relevant_chunks)
+        
+        def stream():
+            pieces = []
+            for piece in self.generate_answer_stream(query, relevant_chunks):
+                pieces.append(piece)
+                yield piece
+            
+            answer = "".join(pieces).strip()
+            if relevant_chunks and not answer.startswith("Error generating answer"):
+                self._store_answer(cache_key, query_embedding, {
+                    "answer": answer,
+                    "sources": sources,
+                    "query": query
+                })
+        
+        return {
+            "answer_stream": stream(),
+            "sources": sources,
+            "query": query
+        }
+    
+    async def answer_question_async(self, query: str) -> Dict:
+        """Like answer_question_stream, but asynchronous and with an async "answer_stream"."""
+        
+        async def single(text):
+            yield text
+        
+        # Encoding and searching block, so run them off the event loop
+        cache_key, query_embedding, cached = await asyncio.to_thread(self._lookup_cache, query)
+        if cached is not None:
+            return {
+                "answer_stream": single(cached["answer"]),
+                "sources": cached["sources"],
+                "query": query
+            }
+        
+        relevant_chunks = await asyncio.to_thread(self.retrieve_relevant_chunks, query, None, query_embedding)
+        
+        if not relevant_chunks:
+            return {
+                "answer_stream": single("I couldn't find any relevant information to answer your question."),
+                "sources": [],
+                "query": query
+            }
+        
+        sources = self._format_sources(relevant_chunks)
+        
+        async def stream_text():
+            pieces = []
+            try:
+                stream = await self._async_client().chat.completions.create(
+                    messages=self._build_messages(query, relevant_chunks),
+                    stream=True,
+                    **_COMPLETION_SETTINGS
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        pieces.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            except Exception as e:
+                yield f"Error generating answer: {str(e)}"
+                return
+            
+            self._store_answer(cache_key, query_embedding, {
+                "answer": "".join(pieces).strip(),
+                "sources": sources,
+                "query": query
             })
         
         return {
-            "answer": answer,
+            "answer_stream": stream_text(),
             "sources": sources,
             "query": query
         }
@@ -1,48 +1,134 @@
+import multiprocessing
 import os
 import re
-from typing import List, Dict
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import List, Dict, Tuple
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the packer just runs as plain Python
+    njit = None
+
+# Compiled once at import instead of on every call
+_WS_RE = re.compile(r'\s+')
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+_META_RE = re.compile(rb'^(Title|Source|Content):[ \t]*(.*)$', re.M)
+
+# Below this many files, starting worker processes costs more than it saves
+_PARALLEL_MIN_FILES = 50
 
 def clean_text(text: str) -> str:
     """Clean and normalize text."""
     # Remove extra whitespace and normalize
-    text = re.sub(r'\s+', ' ', text)
+    text = _WS_RE.sub(' ', text)
     text = text.strip()
     return text
 
+def _split_headers(text: str) -> List[str]:
+    """Split text around Wikivoyage headers such as '== Eat ==', exactly like re.split with a capture group."""
+    parts = []
+    last = 0  # End of the previous header
+    pos = text.find('==')
+    while pos != -1:
+        # Measure the run of '=' starting here; a header opens with its last 2-3
+        run_end = pos
+        while run_end < len(text) and text[run_end] == '=':
+            run_end += 1
+        start = max(pos, run_end - 3)
+        
+        # The title must be non-empty and end at a run of at least two '='
+        close = text.find('=', run_end)
+        if close == -1:
+            break
+        if close > run_end and close + 1 < len(text) and text[close + 1] == '=':
+            end = close + 2
+            if end < len(text) and text[end] == '=':
+                end += 1
+            parts.append(text[last:start])
+            parts.append(text[start:end])
+            last = end
+            pos = text.find('==', end)
+        else:
+            pos = text.find('==', run_end)
+    parts.append(text[last:])
+    return parts
+
+def _pack_sentences(lengths: np.ndarray, min_size: int, max_size: int) -> np.ndarray:
+    """Group consecutive sentences into [start, end) ranges of at most max_size characters."""
+    n = lengths.shape[0]
+    bounds = np.empty((max(n, 1), 2), dtype=np.int32)
+    count = 0
+    
+    # Greedy fill: each chunk takes as many sentences as fit; joined length is total - 1
+    start = 0
+    total = 0
+    for i in range(n):
+        if i > start and total + lengths[i] - 1 > max_size:
+            bounds[count, 0] = start
+            bounds[count, 1] = i
+            count += 1
+            start = i
+            total = 0
+        total += lengths[i]
+    if n > 0:
+        bounds[count, 0] = start
+        bounds[count, 1] = n
+        count += 1
+    
+    # A short tail would be dropped by the min_size filter; split the last two evenly instead.
+    # The boundary only moves left, so the earlier chunk never grows past max_size.
+    if count >= 2 and total - 1 < min_size:
+        first = bounds[count - 2, 0]
+        tail = bounds[count - 1, 0]
+        combined = 0
+        for i in range(first, n):
+            combined += lengths[i]
+        mid = first
+        running = 0
+        while mid < tail and running < combined // 2:
+            running += lengths[mid]
+            mid += 1
+        tail_total = combined - running
+        if mid < tail and tail_total - 1 <= max_size:
+            bounds[count - 2, 1] = mid
+            bounds[count - 1, 0] = mid
+    
+    return bounds[:count]
+
+if njit is not None:
+    _pack_sentences = njit(cache=True)(_pack_sentences)
+
 def chunk_by_sections(text: str, min_size: int = 100, max_size: int = 1200) -> List[str]:
     """Simple chunking based on all Wikivoyage header levels."""
     
     # Split text by all header levels (==, ===, ====)
     # This keeps the headers with their content
-    # Split before any line that starts with 2 or more equals
-    # Handle both cases: newline before header and header at start of text
-    parts = re.split(r"(={2,3}\s*[^=]+?\s*={2,3})", text)
+    parts = _split_headers(text)
     chunks = []
     
-    # Handle the first part (content before any headers)
-    if parts[0].strip():
-        chunks.append(parts[0].strip())
+    # Handle the first part (content before any headers); each part's
+    # whitespace is collapsed here, so the raw document text can be passed in
+    intro = ' '.join(parts[0].split())
+    if intro:
+        chunks.append(intro)
     
     # Process the parts to create proper chunks
     for i in range(1, len(parts), 2):  
-        heading = parts[i].strip()
-        content = parts[i+1].strip() if i+1 < len(parts) else ""
+        heading = ' '.join(parts[i].split())
+        content = ' '.join(parts[i+1].split()) if i+1 < len(parts) else ""
         chunk = heading + "\n" + content if content else heading
         
         if len(chunk) > max_size:
-            # Split into approximately equal chunks at sentence boundaries
+            # Pack whole sentences into chunks that stay within max_size
             
             # Split into sentences (ending with . ! ?)
-            sentences = re.split(r'(?<=[.!?])\s+', chunk)
-            
-            chunk_count = (len(chunk) + max_size - 1) // max_size  # Ceiling division
-            sentences_per_chunk = len(sentences) // chunk_count
-            remainder = len(sentences) % chunk_count  # Extra sentences to distribute
+            sentences = _SENT_RE.split(chunk)
+            lengths = np.fromiter((len(s) + 1 for s in sentences), dtype=np.int32, count=len(sentences))
             
-            for i in range(chunk_count):
-                start_idx = i * sentences_per_chunk + min(i, remainder)
-                end_idx = start_idx + sentences_per_chunk + (1 if i < remainder else 0)
-                
+            for start_idx, end_idx in _pack_sentences(lengths, min_size, max_size):
                 sub_chunk = ' '.join(sentences[start_idx:end_idx])
                 
                 # Only add if it's not too small
@@ -55,6 +141,60 @@ def chunk_by_sections(text: str, min_size: int = 100, max_size: int = 1200) -> L
     
     return chunks
 
+def _process_one_file(filepath: str, min_chunk_size: int = 100, max_chunk_size: int = 1200) -> Tuple[List[Dict], str]:
+    """Read one travel document and split it into chunks, returning them with a log message."""
+    filename = os.path.basename(filepath)
+    
+    try:
+        # Read raw bytes; only the header fields and the body get decoded
+        raw = Path(filepath).read_bytes()
+        
+        # Extract metadata from file content: one regex pass over the header
+        # finds Title/Source and the Content: marker that ends the header
+        title = "Unknown"
+        source = "Unknown"
+        content_start = -1
+        for match in _META_RE.finditer(raw, 0, 2048):
+            field, value = match.group(1), match.group(2).decode('utf-8').strip()
+            if field == b'Content':
+                content_start = match.start()
+                break
+            if field == b'Title' and value:
+                title = value
+            elif field == b'Source' and value:
+                source = value
+        
+        if content_start == -1:
+            content_start = raw.find(b'Content:')
+        
+        # Extract actual content (skip header)
+        if content_start != -1:
+            actual_content = raw[content_start + 8:].decode('utf-8').strip()
+        else:
+            actual_content = raw.decode('utf-8')
+        
+        # Split into section-based chunks (whitespace is normalized per chunk)
+        chunks = chunk_by_sections(actual_content, min_chunk_size, max_chunk_size)
+        
+        # Create document entries
+        documents = []
+        for i, chunk in enumerate(chunks):
+            doc = {
+                'id': f"{title}_{i}",
+                'title': title,
+                'source': source,
+                'content': chunk,
+                'chunk_index': i,
+                'source_file': filename,
+                'chunk_size': len(chunk)
+            }
+            documents.append(doc)
+        
+        return documents, f"[SUCCESS] Processed {filename}: {len(chunks)} chunks (Title: {title}, Source: {source})"
+        
+    except Exception as e:
+        return [], f"[ERROR] Error processing {filename}: {str(e)}"
+
 def process_travel_documents(data_dir: str = "travel_data", min_chunk_size: int = 100, max_chunk_size: int = 1200) -> List[Dict]:
     """Process all travel documents and split them into section-based chunks."""
     
@@ -64,59 +204,35 @@ def process_travel_documents(data_dir: str = "travel_data", min_chunk_size: int
         print(f"[ERROR] Data directory '{data_dir}' not found!")
         return documents
     
-    # Process each text file
-    for filename in os.listdir(data_dir):
-        if filename.endswith('.txt'):
-            filepath = os.path.join(data_dir, filename)
-            
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                # Extract metadata from file content
-                lines = content.split('\n')
-                title = "Unknown"
-                source = "Unknown"
-                
-                # Look for title and source in header
-                for line in lines[:5]:
-                    if line.startswith('Title: '):
-                        title = line.replace('Title: ', '').strip()
-                    elif line.startswith('Source: '):
-                        source = line.replace('Source: ', '').strip()
-                    elif title != "Unknown" and source != "Unknown":
-                        break
-                
-                # Extract actual content (skip header)
-                content_start = content.find('Content:')
-                if content_start != -1:
-                    actual_content = content[content_start + 8:].strip()
-                else:
-                    actual_content = content
-                
-                # Clean the content
-                cleaned_content = clean_text(actual_content)
-                
-                # Split into section-based chunks
-                chunks = chunk_by_sections(cleaned_content, min_chunk_size, max_chunk_size)
-                
-                # Create document entries
-                for i, chunk in enumerate(chunks):
-                    doc = {
-                        'id': f"{title}_{i}",
-                        'title': title,
-                        'source': source,
-                        'content': chunk,
-                        'chunk_index': i,
-                        'source_file': filename,
-                        'chunk_size': len(chunk)
-                    }
-                    documents.append(doc)
-                
-                print(f"[SUCCESS] Processed {filename}: {len(chunks)} chunks (Title: {title}, Source: {source})")
-                
-            except Exception as e:
-                print(f"[ERROR] Error processing {filename}: {str(e)}")
+    filepaths = [entry.path for entry in os.scandir(data_dir) if entry.name.endswith('.txt')]
+    if not filepaths:
+        print(f"\n[COMPLETE] Total documents processed: {len(documents)}")
+        return documents
+    
+    if len(filepaths) < _PARALLEL_MIN_FILES:
+        for filepath in filepaths:
+            file_documents, message = _process_one_file(filepath, min_chunk_size, max_chunk_size)
+            documents.extend(file_documents)
+            print(message)
+        print(f"\n[COMPLETE] Total documents processed: {len(documents)}")
+        return documents
+    
+    # Chunking is pure-Python regex work, so spread files across processes.
+    # Workers are not forked: the caller (e.g. Streamlit) may be multi-threaded
+    # with torch already loaded, and forking that can deadlock.
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    workers = min(os.cpu_count() or 1, len(filepaths))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as executor:
+        results = executor.map(
+            _process_one_file,
+            filepaths,
+            repeat(min_chunk_size),
+            repeat(max_chunk_size),
+            chunksize=4
+        )
+        for file_documents, message in results:
+            documents.extend(file_documents)
+            print(message)
     
     print(f"\n[COMPLETE] Total documents processed: {len(documents)}")
     return documents
@@ -1,64 +1,411 @@
 import faiss
 import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import torch
 from sentence_transformers import SentenceTransformer
+from sentence_transformers.models import Pooling, Transformer
 from typing import List, Dict, Tuple
-import pickle
+from collections import OrderedDict
+import functools
+import hashlib
+import json
 import os
+import threading
+
+# FAISS parallelizes search across OpenMP threads; past ~8 the memory bus is the limit
+faiss.omp_set_num_threads(min(8, os.cpu_count() or 1))
+
+@functools.lru_cache(maxsize=4)
+def _get_model(model_name: str, backend: str = "torch") -> SentenceTransformer:
+    """Load a sentence transformer once per process and reuse it."""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # Only the CPUs this process may run on, which respects container limits
+    if hasattr(os, "sched_getaffinity"):
+        torch.set_num_threads(len(os.sched_getaffinity(0)))
+    else:
+        torch.set_num_threads(os.cpu_count() or 1)
+    if backend == "torch":
+        model = SentenceTransformer(model_name, device=device)
+    else:
+        model_kwargs = None
+        if backend == "onnx":
+            # Run the exported graph on the GPU when onnxruntime-gpu is installed
+            import onnxruntime
+            provider = "CUDAExecutionProvider"
+            if provider not in onnxruntime.get_available_providers():
+                provider = "CPUExecutionProvider"
+            model_kwargs = {"provider": provider}
+        model = SentenceTransformer(model_name, device=device, backend=backend, model_kwargs=model_kwargs)
+    if device == "cuda" and backend == "torch":
+        model.half()  # FP16 inference roughly doubles GPU encode throughput
+    return model
+
+def _is_mean_pooled(model: SentenceTransformer) -> bool:
+    """True if the model is a plain transformer + mean pooling (+ normalize) stack."""
+    # Prompts and lowercasing change the input text, which the fast path doesn't replicate
+    if model.default_prompt_name is not None or getattr(model[0], "do_lower_case", False):
+        return False
+    
+    modules = list(model)
+    if not (len(modules) >= 2 and isinstance(modules[0], Transformer) and isinstance(modules[1], Pooling)):
+        return False
+    if not all(type(module).__name__ == "Normalize" for module in modules[2:]):
+        return False
+    
+    config = modules[1].get_config_dict()
+    modes = {key for key, value in config.items() if key.startswith("pooling_mode") and value}
+    return modes == {"pooling_mode_mean_tokens"} or config.get("pooling_mode") == "mean"
 
 class SimpleVectorStore:
     """Simple vector store using FAISS for document retrieval."""
     
-    def __init__(self, model_name: str = "all-mpnet-base-v2"):
+    def __init__(self, model_name: str = "all-mpnet-base-v2", backend: str = "torch",
+                 similarity_threshold: float = 0.97, cache_size: int = 512, cache_dir: str = None):
         """Initialize the vector store with a sentence transformer model."""
-        self.model = SentenceTransformer(model_name)
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.model = _get_model(model_name, backend)
+        self._fast_query = backend == "torch" and _is_mean_pooled(self.model)
         self.index = None
-        self.documents = []
+        self.embeddings = None  # Full-precision rows behind the quantized index
+        self._set_documents([])
         self.dimension = self.model.get_sentence_embedding_dimension()
+        self.similarity_threshold = similarity_threshold
+        self.cache_size = cache_size
+        self.version = 0  # Bumped whenever the indexed documents change
+        self._cache_lock = threading.Lock()  # The store is shared across Streamlit sessions
+        self._clear_query_cache()
+    
+    def _set_documents(self, documents: List[Dict]):
+        """Store document metadata as parallel arrays indexed by document."""
+        self.ids = np.array([doc['id'] for doc in documents], dtype=str)
+        self.titles = np.array([doc['title'] for doc in documents], dtype=str)
+        self.sources = np.array([doc.get('source', "Unknown") for doc in documents], dtype=str)
+        self.source_files = np.array([doc['source_file'] for doc in documents], dtype=str)
+        self.chunk_indices = np.array([doc['chunk_index'] for doc in documents], dtype=np.int32)
+        self.contents = [doc['content'] for doc in documents]  # Variable length, kept as a list
+        self._assign_rows()
+    
+    def _assign_rows(self):
+        """Map documents to index rows, giving identical chunks a single shared row."""
+        row_of = {}
+        self.doc_rows = np.array([row_of.setdefault(content, len(row_of)) for content in self.contents], dtype=np.int32)
+        self.row_docs = np.unique(self.doc_rows, return_index=True)[1]  # First document of each row
+    
+    def _document(self, i: int) -> Dict:
+        """Rebuild the document dict for row i."""
+        content = self.contents[i]
+        return {
+            'id': str(self.ids[i]),
+            'title': str(self.titles[i]),
+            'source': str(self.sources[i]),
+            'content': content,
+            'chunk_index': int(self.chunk_indices[i]),
+            'source_file': str(self.source_files[i]),
+            'chunk_size': len(content)
+        }
+    
+    @property
+    def documents(self) -> List[Dict]:
+        """All stored documents as dicts."""
+        return [self._document(i) for i in range(len(self))]
+    
+    def __len__(self) -> int:
+        return len(self.contents)
+    
+    def _clear_query_cache(self):
+        """Forget cached search results, e.g. after the index changes."""
+        with self._cache_lock:
+            self.version += 1
+            self._query_cache = OrderedDict()  # query text -> (top_k, results)
+            self._cache_embs = np.zeros((self.cache_size, self.dimension), dtype=np.float32)
+            self._cache_results = [None] * self.cache_size  # ring buffer of (top_k, results)
+            self._cache_count = 0
+    
+    def _encode_texts(self, texts: List[str]) -> np.ndarray:
+        """Encode texts into unit-length embeddings."""
+        # One encode call with a large batch; the model normalizes for us.
+        # Halve the batch on GPU out-of-memory instead of failing outright.
+        batch_size = min(256 if self.model.device.type == "cuda" else 128, len(texts))
+        while True:
+            try:
+                embeddings = self.model.encode(
+                    texts,
+                    batch_size=batch_size,
+                    show_progress_bar=True,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+                print(f"Encoded {len(texts)} chunks with batch size {batch_size}")
+                # Already float32 on CPU, so this only converts FP16 GPU output
+                return embeddings.astype(np.float32, copy=False)
+            except torch.cuda.OutOfMemoryError:
+                if batch_size <= 4:
+                    raise
+                torch.cuda.empty_cache()
+                batch_size = max(4, batch_size // 2)
+                print(f"WARNING: Out of GPU memory, retrying with batch size {batch_size}")
+    
+    def _emb_cache_paths(self) -> Tuple[str, str]:
+        """Paths of the embedding matrix and its row keys for this model."""
+        name = self.model_name.replace('/', '_')
+        return (os.path.join(self.cache_dir, f"{name}.npy"),
+                os.path.join(self.cache_dir, f"{name}.keys.json"))
+    
+    def _chunk_keys(self, documents: List[Dict]) -> List[str]:
+        """Content hash of each document, used as its embedding cache key."""
+        return [hashlib.blake2b(doc['content'].encode('utf-8'), digest_size=16).hexdigest() for doc in documents]
     
-    def add_documents(self, documents: List[Dict]):
-        """Add documents to the vector store."""
+    def _load_emb_cache(self) -> Tuple[List[str], np.ndarray]:
+        """Read the cached row keys and (memory-mapped) embedding matrix, if any."""
+        matrix_path, keys_path = self._emb_cache_paths()
+        if not (os.path.exists(matrix_path) and os.path.exists(keys_path)):
+            return [], np.empty((0, self.dimension), dtype=np.float32)
+        try:
+            with open(keys_path, 'r', encoding='utf-8') as f:
+                cached_keys = json.load(f)
+            cached = np.load(matrix_path, mmap_mode='r')
+            if len(cached) != len(cached_keys):
+                raise ValueError("cache keys and matrix are out of sync")
+            return cached_keys, cached
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Ignoring embedding cache: {str(e)}")
+            return [], np.empty((0, self.dimension), dtype=np.float32)
+    
+    def _write_emb_cache(self, keys: List[str], matrix: np.ndarray):
+        """Write the embedding cache to temp files, then swap them in."""
+        matrix_path, keys_path = self._emb_cache_paths()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.save(f"{matrix_path}.tmp.npy", matrix, allow_pickle=False)
+            with open(f"{keys_path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(keys, f)
+            os.replace(f"{matrix_path}.tmp.npy", matrix_path)
+            os.replace(f"{keys_path}.tmp", keys_path)
+        except OSError as e:
+            print(f"WARNING: Could not update embedding cache: {str(e)}")
+    
+    def embed_documents(self, documents: List[Dict]) -> np.ndarray:
+        """Encode document contents into unit-length embeddings."""
+        print("Creating embeddings...")
+        texts = [doc['content'] for doc in documents]
+        keys = self._chunk_keys(documents)
+        
+        cached_keys, cached = [], np.empty((0, self.dimension), dtype=np.float32)
+        if self.cache_dir is not None:
+            cached_keys, cached = self._load_emb_cache()
+        
+        rows = {key: row for row, key in enumerate(cached_keys)}
+        hit_indices = [i for i, key in enumerate(keys) if key in rows]
+        missing_indices = [i for i, key in enumerate(keys) if key not in rows]
+        if self.cache_dir is not None:
+            print(f"Reused {len(hit_indices)} cached embeddings, {len(missing_indices)} chunks left to encode")
+        
+        embeddings = None
+        if hit_indices:
+            embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+            embeddings[hit_indices] = cached[[rows[keys[i]] for i in hit_indices]]
+        
+        if missing_indices:
+            # Drop repeats of the same chunk so each new key is encoded and cached once
+            first_index = {}
+            for i in missing_indices:
+                first_index.setdefault(keys[i], i)
+            new_keys = list(first_index)
+            if len(new_keys) < len(missing_indices):
+                print(f"Skipping {len(missing_indices) - len(new_keys)} duplicate chunks")
+            new_embeddings = self._encode_texts([texts[i] for i in first_index.values()])
+            
+            if len(new_keys) == len(texts):
+                # Cold cache, every chunk unique: rows are already in document order
+                embeddings = new_embeddings
+            else:
+                if embeddings is None:
+                    embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+                new_rows = {key: row for row, key in enumerate(new_keys)}
+                embeddings[missing_indices] = new_embeddings[[new_rows[keys[i]] for i in missing_indices]]
+            
+            # Append the new rows; entries for other corpora sharing this cache_dir stay
+            if self.cache_dir is not None:
+                grown = np.concatenate([cached, new_embeddings], dtype=np.float32) if len(cached) else new_embeddings
+                del cached  # Release the memory map before replacing the file under it
+                self._write_emb_cache(cached_keys + new_keys, grown)
+        
+        return embeddings
+    
+    def prune_embedding_cache(self, documents: List[Dict] = None) -> int:
+        """Drop cached embeddings for chunks not in documents (default: this store's documents)."""
+        if self.cache_dir is None:
+            return 0
+        
+        wanted = set(self._chunk_keys(self.documents if documents is None else documents))
+        cached_keys, cached = self._load_emb_cache()
+        kept_rows = [row for row, key in enumerate(cached_keys) if key in wanted]
+        pruned = len(cached_keys) - len(kept_rows)
+        if pruned:
+            kept = np.ascontiguousarray(cached[kept_rows])
+            del cached
+            self._write_emb_cache([cached_keys[row] for row in kept_rows], kept)
+        
+        print(f"Pruned {pruned} stale embeddings from the cache")
+        return pruned
+    
+    def add_documents(self, documents: List[Dict], embeddings: np.ndarray = None):
+        """Add documents to the vector store, reusing precomputed embeddings if given."""
         if not documents:
             print("ERROR: No documents to add!")
             return
         
-        self.documents = documents
+        self._set_documents(documents)
+        self._clear_query_cache()
         
         # Create embeddings for all documents
-        print("Creating embeddings...")
-        texts = [doc['content'] for doc in documents]
-        embeddings = self.model.encode(texts, show_progress_bar=True)
+        if embeddings is None:
+            embeddings = self.embed_documents(documents)
         
-        # Initialize FAISS index
-        # This is the vector store
-        self.index = faiss.IndexFlatIP(self.dimension)  # Inner product for cosine similarity  
-        
-        # Normalize embeddings for cosine similarity
-        faiss.normalize_L2(embeddings)
-        
-        # Add to index
-        self.index.add(embeddings.astype('float32'))
+        # One row per distinct chunk, so repeats can't crowd out the top-k
+        self.embeddings = np.ascontiguousarray(np.asarray(embeddings)[self.row_docs], dtype=np.float32)
+        self._build_index(self.embeddings)
         
         print(f"SUCCESS: Added {len(documents)} documents to vector store")
         print(f"Index size: {self.index.ntotal} vectors")
     
+    def _build_index(self, embeddings: np.ndarray):
+        """Build the FAISS index over embeddings, one row per distinct chunk."""
+        # This is the vector store: an HNSW graph for sublinear search over
+        # 8-bit scalar-quantized vectors (4x smaller than FP32); inner product
+        # on unit vectors is cosine.
+        self.index = faiss.IndexHNSWSQ(
+            self.dimension, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT
+        )
+        self.index.hnsw.efConstruction = 200
+        
+        # Add to index (FAISS wants C-contiguous float32; a no-op for encoder output)
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.index.train(embeddings)  # Learns the per-dimension ranges for SQ8
+        self.index.add(embeddings)
+    
+    def remove(self, doc_ids: List[str]) -> int:
+        """Remove documents by id and return how many were removed."""
+        if self.index is None:
+            print("ERROR: Vector store is empty!")
+            return 0
+        
+        keep = ~np.isin(self.ids, list(doc_ids))
+        removed = int((~keep).sum())
+        if removed == 0:
+            return 0
+        if self.embeddings is None:
+            print("ERROR: No full-precision embeddings stored; add the documents again instead")
+            return 0
+        
+        kept_rows = self.doc_rows[keep]
+        self.ids = self.ids[keep]
+        self.titles = self.titles[keep]
+        self.sources = self.sources[keep]
+        self.source_files = self.source_files[keep]
+        self.chunk_indices = self.chunk_indices[keep]
+        self.contents = [content for content, k in zip(self.contents, keep) if k]
+        self._assign_rows()
+        self.embeddings = np.ascontiguousarray(self.embeddings[kept_rows[self.row_docs]])
+        self._clear_query_cache()
+        
+        if len(self) == 0:
+            self.index = None
+        else:
+            # HNSW can't drop nodes in place, so rebuild the graph. Use the stored
+            # full-precision rows: the SQ8 codes in the index are lossy and would
+            # degrade with every rebuild.
+            self._build_index(self.embeddings)
+        
+        print(f"SUCCESS: Removed {removed} documents, {len(self)} remaining")
+        return removed
+    
+    def encode_query(self, query: str) -> np.ndarray:
+        """Encode a query into a (1, dimension) unit-length float32 array."""
+        if self._fast_query:
+            return self._encode_one(query)
+        
+        # Already unit-length, so inner product == cosine
+        query_embedding = self.model.encode([query], convert_to_numpy=True, normalize_embeddings=True)
+        return np.ascontiguousarray(query_embedding, dtype=np.float32)
+    
+    def _encode_one(self, query: str) -> np.ndarray:
+        """Encode a single query by calling the transformer directly."""
+        features = self.model.tokenize([query])
+        features = {key: value.to(self.model.device) if isinstance(value, torch.Tensor) else value
+                    for key, value in features.items()}
+        
+        with torch.inference_mode():
+            token_embeddings = self.model[0](features)['token_embeddings']
+            mask = features['attention_mask'].unsqueeze(-1).to(token_embeddings.dtype)
+            embedding = (token_embeddings * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            embedding = torch.nn.functional.normalize(embedding, dim=1)
+        
+        return np.ascontiguousarray(embedding.float().cpu().numpy(), dtype=np.float32)
+    
     def search(self, query: str, top_k: int = 5) -> List[Tuple[Dict, float]]:
         """Search for similar documents."""
         if self.index is None:
             print("ERROR: Vector store is empty! Add documents first.")
             return []
         
-        # Encode query
-        query_embedding = self.model.encode([query])
-        faiss.normalize_L2(query_embedding)
+        # Exact repeats skip the encoder entirely
+        with self._cache_lock:
+            version = self.version
+            cached = self._query_cache.get(query)
+            if cached is not None and cached[0] >= top_k:
+                self._query_cache.move_to_end(query)
+                return cached[1][:top_k]
         
-        # Search
-        scores, indices = self.index.search(query_embedding.astype('float32'), top_k)
+        results = self.search_by_embedding(self.encode_query(query), top_k)
+        
+        with self._cache_lock:
+            # Skip storing if the index changed while we were searching
+            if self.cache_size and self.version == version:
+                self._query_cache[query] = (top_k, results)
+                if len(self._query_cache) > self.cache_size:
+                    self._query_cache.popitem(last=False)
+        return results
+    
+    def search_by_embedding(self, query_embedding: np.ndarray, top_k: int = 5) -> List[Tuple[Dict, float]]:
+        """Search for similar documents using an already encoded query."""
+        if self.index is None:
+            print("ERROR: Vector store is empty! Add documents first.")
+            return []
+        
+        # Near-duplicate queries reuse earlier results instead of searching again
+        with self._cache_lock:
+            version = self.version
+            filled = min(self._cache_count, self.cache_size)
+            if filled:
+                similarities = self._cache_embs[:filled] @ query_embedding[0]
+                best = int(np.argmax(similarities))
+                cached_k, cached_results = self._cache_results[best]
+                if similarities[best] > self.similarity_threshold and cached_k >= top_k:
+                    return cached_results[:top_k]
+        requested_k = top_k
+        
+        # Search (FAISS keeps a top-k heap, so never ask for more than we have)
+        top_k = min(top_k, self.index.ntotal)
+        # Per-call params rather than index.hnsw.efSearch, which concurrent searches share
+        params = faiss.SearchParametersHNSW(efSearch=max(64, top_k * 8))
+        scores, indices = self.index.search(query_embedding, top_k, params=params)
         
         # Return results with documents and scores
         results = []
         for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-            if idx < len(self.documents):
-                results.append((self.documents[idx], float(score)))
+            if 0 <= idx < len(self.row_docs):
+                results.append((self._document(self.row_docs[idx]), float(score)))
+        
+        # Remember this query, overwriting the oldest slot once full
+        with self._cache_lock:
+            if self.cache_size and self.version == version:
+                slot = self._cache_count % self.cache_size
+                self._cache_embs[slot] = query_embedding[0]
+                self._cache_results[slot] = (requested_k, results)
+                self._cache_count += 1
         
         return results
     
@@ -68,34 +415,64 @@ class SimpleVectorStore:
             print("ERROR: Nothing to save - vector store is empty!")
             return
         
-        # Save FAISS index
-        faiss.write_index(self.index, f"{filepath}.faiss")
+        # Save FAISS index via a temp file: a loaded index may be memory-mapped
+        # from the target, so writing over it in place would pull pages out from under it
+        faiss.write_index(self.index, f"{filepath}.faiss.tmp")
+        os.replace(f"{filepath}.faiss.tmp", f"{filepath}.faiss")
+        
+        # Save the full-precision rows so remove() can rebuild the index after a load
+        np.save(f"{filepath}.tmp.npy", self.embeddings, allow_pickle=False)
+        os.replace(f"{filepath}.tmp.npy", f"{filepath}.npy")
         
-        # Save documents
-        with open(f"{filepath}.pkl", 'wb') as f:
-            pickle.dump(self.documents, f)
+        # Save document metadata column by column
+        table = pa.Table.from_pydict({
+            'id': self.ids,
+            'title': self.titles,
+            'source': self.sources,
+            'content': self.contents,
+            'source_file': self.source_files,
+            'chunk_index': self.chunk_indices
+        })
+        feather.write_feather(table, f"{filepath}.arrow")
         
         print(f"SUCCESS: Vector store saved to {filepath}")
     
     def load(self, filepath: str):
         """Load the vector store from disk."""
         try:
-            # Load FAISS index
-            self.index = faiss.read_index(f"{filepath}.faiss")
+            # Load FAISS index, memory-mapping the stored vectors where supported
+            # so pages fault in on demand and are shared between processes
+            self.index = faiss.read_index(f"{filepath}.faiss", getattr(faiss, "IO_FLAG_MMAP_IFC", 0))
+            
+            # Full-precision rows are only read by remove(), so leave them on disk
+            embeddings_path = f"{filepath}.npy"
+            self.embeddings = np.load(embeddings_path, mmap_mode='r') if os.path.exists(embeddings_path) else None
             
-            # Load documents
-            with open(f"{filepath}.pkl", 'rb') as f:
-                self.documents = pickle.load(f)
+            # Load document metadata straight into the column arrays
+            table = feather.read_table(f"{filepath}.arrow")
+            self.ids = table.column('id').to_numpy(zero_copy_only=False).astype(str)
+            self.titles = table.column('title').to_numpy(zero_copy_only=False).astype(str)
+            self.sources = table.column('source').to_numpy(zero_copy_only=False).astype(str)
+            self.contents = table.column('content').to_pylist()
+            self.source_files = table.column('source_file').to_numpy(zero_copy_only=False).astype(str)
+            self.chunk_indices = table.column('chunk_index').to_numpy().astype(np.int32)
+            self._assign_rows()
+            if self.index.ntotal != len(self.row_docs):
+                # Saved before identical chunks shared a row: one row per document
+                self.doc_rows = np.arange(len(self), dtype=np.int32)
+                self.row_docs = np.arange(len(self))
+            self._clear_query_cache()
             
             print(f"SUCCESS: Vector store loaded from {filepath}")
-            print(f"Loaded {len(self.documents)} documents")
+            print(f"Loaded {len(self)} documents")
             
         except Exception as e:
             print(f"ERROR: Error loading vector store: {str(e)}")
 
-def create_vector_store(documents: List[Dict], model_name: str = "all-mpnet-base-v2") -> SimpleVectorStore:
+def create_vector_store(documents: List[Dict], model_name: str = "all-mpnet-base-v2", backend: str = "torch",
+                        cache_dir: str = "storage/embeddings") -> SimpleVectorStore:
     """Helper function to create and populate a vector store."""
-    vector_store = SimpleVectorStore(model_name)
+    vector_store = SimpleVectorStore(model_name, backend, cache_dir=cache_dir)
     vector_store.add_documents(documents)
     return vector_store
 
@@ -40,7 +40,7 @@ def setup_rag():
         return None
     
     # Try to load existing vector store first
-    if VECTOR_BASENAME.with_suffix(".faiss").exists() and VECTOR_BASENAME.with_suffix(".pkl").exists():
+    if VECTOR_BASENAME.with_suffix(".faiss").exists() and VECTOR_BASENAME.with_suffix(".arrow").exists():
         st.info("Loading existing vector store...")
         try:
             vs = SimpleVectorStore()
@@ -105,11 +105,11 @@ def main():
         with st.chat_message("assistant"):
             with st.spinner("Thinking..."):
                 try:
-                    result = rag.answer_question(prompt)
-                    response = result['answer']
+                    result = rag.answer_question_stream(prompt)
                     
-                    # Display answer first
-                    st.markdown(f"**Answer:** {response}")
+                    # Display answer first, rendering tokens as they arrive
+                    st.markdown("**Answer:**")
+                    response = st.write_stream(result['answer_stream'])
                     
                     # Display sources separately with full details
                     if result['sources']: